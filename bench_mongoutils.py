@@ -0,0 +1,56 @@
+"""Compare dict-per-row and tabular serialization of a homogeneous QuerySet
+
+Needs a local MongoDB, like the tests:
+
+    python bench_mongoutils.py [number-of-books]
+"""
+from __future__ import print_function
+
+import gc
+import json
+import sys
+import time
+
+from flask import current_app
+from flask_mongoutils import object_to_dict
+from test_mongoutils import create_app
+from myapp.author.models import Author
+from myapp.book.models import Book
+from myapp.modules.publisher.models import Publisher
+
+
+def measure(label, func, repeat=5):
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        started = time.time()
+        out = func()
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    size = len(json.dumps(out, default=str))
+    print("%-10s %8.1f ms %10d bytes" % (label, best * 1000, size))
+    return out
+
+
+def main(count=5000):
+    app = create_app()
+    app.name = 'myapp'
+    with app.app_context():
+        author = Author(name='benchauthor', uri='path/somewhere').save()
+        publisher = Publisher(name='benchpub').save()
+        Book.objects.insert([Book(title='book %d' % i, author=author, publisher=publisher,
+                                  tags=['a', 'b', 'c']) for i in range(count)])
+        try:
+            options = dict(app=current_app, uri_fields=[])
+            print("%d books" % count)
+            measure('dicts', lambda: object_to_dict(Book.objects, **options))
+            measure('rows', lambda: object_to_dict(Book.objects, tabular=True, **options))
+            measure('columns', lambda: object_to_dict(Book.objects, tabular='columns', **options))
+        finally:
+            Author.drop_collection()
+            Book.drop_collection()
+            Publisher.drop_collection()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
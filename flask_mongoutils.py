@@ -17,14 +17,30 @@ __all__ = ['MongoUtils']
 import re
 
 # -*- coding: utf-8 -*-
+from collections import OrderedDict
+from flask import Blueprint, Response, current_app, has_request_context, request
 from itertools import groupby
-from mongoengine import Document, EmbeddedDocument
+from mongoengine import (Document, EmbeddedDocument, EmbeddedDocumentField,
+                         GenericReferenceField, ListField, ReferenceField, signals)
 from mongoengine.queryset import QuerySet
 from numbers import Number
+from pymongo import ReadPreference
+from pymongo.errors import ExecutionTimeout
 from types import ModuleType
+import argparse
+import bisect
 import bson
+import cProfile
+import json
+import multiprocessing
 import os
+import random
 import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
 from datetime import datetime
 
 def object_to_dict(obj=None, recursive=False, depth=1, **kwargs):
@@ -62,7 +78,39 @@ def object_to_dict(obj=None, recursive=False, depth=1, **kwargs):
             E.g. `{ 'Creators': 'path.to.model' }` would be the same as:
                 `from <current_project_name>.path.to.model import Creators`
             See the lazy_load function below for an implementation example.
+        list_limits (dict): Maximum number of items to return for the named list fields,
+            eg. {'comments': 50}. Applied all the way down, and pushed down as $slice
+            projections on QuerySets and dereference queries.
+        list_totals (bool): Whether to add the full length of lists that were
+            truncated to the output as {'_list_totals': {'comments': 1234}}.
+            Defaults to True. For
+            lists sliced in the database this costs one aggregate per query.
+        query_options (dict): Options for the dereference queries, per collection
+            name, with '*' for all collections. Merged over MONGOUTILS_QUERY_OPTIONS.
+            {'author': {'read_preference': 'secondary_preferred', 'max_time_ms': 50,
+                        'hint': [('_id', 1)], 'batch_size': 100,
+                        'no_cursor_timeout': True}}
+            A reference whose query exceeds max_time_ms is returned as its stub,
+            {'collection': ..., 'id': ...}.
+        use_orphan_cache (bool): Whether to skip references recently found to be
+            orphaned (see OrphanCache). Defaults to True.
+        deref_cache (dict): Optional cache of dereferenced documents, keyed by
+            (collection, id, use_derefs, fields spec of the reference). Share
+            one dict across calls to avoid re-fetching the same referenced
+            documents, e.g. in bulk exports.
+            Only share a cache between calls that use the same options.
+        tabular (bool or str): Serialize a QuerySet as a table rather than a list of
+            dicts: {'columns': [...], 'rows': [[...], ...]}, or with 'columns',
+            {'columns': [...], 'data': {'column': [...], ...}}. Columns are the
+            model's fields, in definition order, after exclusions.
+        fields (dict or list): Sparse fieldset, as a nested spec or a list of dotted
+            paths, eg. {'title': 1, 'author': {'name': 1, 'uri': 1}, 'publisher': 0}
+            or ['title', 'author.name', 'author.uri']. Drives which keys are
+            emitted, which references are followed (only those given a nested
+            spec, regardless of `depth`), and the .only()/.exclude() projections
+            of QuerySets and dereference queries. See compile_fields.
         current_depth (int): Internal. Stores internal recursion state.
+        current_field (str): Internal. Name of the field being serialized.
 
     Returns:
         Dictionary version of the provided object
@@ -79,12 +127,24 @@ def object_to_dict(obj=None, recursive=False, depth=1, **kwargs):
         raise Exception("Object Encoder expects to receive 'app' as a flask instance (flask.current_app")
     app = kwargs.get('app')
 
+    # Top-level calls are timed and counted when metrics or profiling are enabled
+    if kwargs.get('current_depth') is None and '_stats' not in kwargs:
+        if ( app.config.get('MONGOUTILS_METRICS') or
+             app.config.get('MONGOUTILS_PROFILE_SAMPLE_RATE') or
+             app.config.get('MONGOUTILS_PROFILE_SLOW_MS') ):
+            return _observe_serialization(app, obj, recursive, depth, kwargs)
+    stats = kwargs.get('_stats')
+
     asset_info = kwargs.get('asset_info') or {}
     # If resource-path is provided then use that, otherwise the url-path
     # TODO: Should the caller have a different expectation based on which value is
     #   sent? Why bother having a dict, rather than a single ASSET_PREFIX value?
     ASSET_URL = asset_info.get('ASSET_RESOURCE') or asset_info.get('ASSET_URL') or ''
 
+    # Compile the fields spec once, at the top of the recursion
+    if kwargs.get('current_depth') is None and kwargs.get('fields') is not None:
+        kwargs['fields'] = compile_fields(kwargs.get('fields'))
+
     if (  kwargs.get('current_depth') is not None and
           kwargs.get('current_depth') > 0 and
           kwargs.get('current_depth') >= depth and 
@@ -98,11 +158,20 @@ def object_to_dict(obj=None, recursive=False, depth=1, **kwargs):
     # Dynamic keys to pass up the recursion stack
     if kwargs.get('delete_keys') is None: 
         kwargs['delete_keys'] = []
+
+    # Totals of $slice'd list fields, only meant for this (document) level.
+    # Like lists capped in memory, only lists that were truncated are reported
+    list_totals = kwargs.pop('_doc_list_totals', None)
+    list_limits = kwargs.get('list_limits')
+    if list_totals:
+        list_totals = dict((name, total) for name, total in list_totals.items()
+                           if total > list_limits.get(name, total))
       
     if obj is None:
         return obj
     
     if isinstance(obj, (Document, EmbeddedDocument)):
+        _count(stats, 'documents')
         # This may not be very portable, so need to figure out a bit more configurable
         # solution for other projects
         if kwargs.get('types_as_str_repr') and obj.__class__.__name__ in kwargs.get('types_as_str_repr'):
@@ -112,11 +181,19 @@ def object_to_dict(obj=None, recursive=False, depth=1, **kwargs):
         
         out = dict(obj._data)
         _private_fields = getattr(obj, '_PRIVATE_FIELDS', None)
+        list_totals = dict(list_totals or {})
+        spec = kwargs.get('fields')
         for k,v in out.items():
             if kwargs.get('exclude_fields') and k in kwargs.get('exclude_fields'):
                 out[k] = None
                 kwargs['delete_keys'].append(k)
                 continue
+            if spec is not None:
+                kwargs['fields'] = field_spec(spec, k)
+                if kwargs['fields'] is False:
+                    out[k] = None
+                    kwargs['delete_keys'].append(k)
+                    continue
             if k in ['_PRIVATE_FIELDS']:
                 out[k] = None
                 kwargs['delete_keys'].append(k)
@@ -129,7 +206,16 @@ def object_to_dict(obj=None, recursive=False, depth=1, **kwargs):
             if v is None and kwargs.get('exclude_nulls'):
                 out.pop(k)
                 continue
+
+            # Cap huge lists before their items get (possibly) dereferenced
+            if list_limits and k in list_limits and isinstance(v, list):
+                if len(v) > list_limits[k]:
+                    if kwargs.get('list_totals', True):
+                        list_totals.setdefault(k, len(v))
+                    v = v[:list_limits[k]]
             
+            kwargs['current_field'] = k
+
             # Apply the URL absolute path prefix for the defined fields
             if kwargs.get('uri_fields') and k in kwargs.get('uri_fields'):
                 kwargs['apply_url_prefix'] = True
@@ -189,10 +275,28 @@ def object_to_dict(obj=None, recursive=False, depth=1, **kwargs):
                 
         # Remove our tracker for the next loop
         if kwargs.get('delete_keys'): kwargs['delete_keys'] = []
+
+        if list_totals:
+            out['_list_totals'] = list_totals
                     
     elif isinstance(obj, QuerySet):
-        out = [object_to_dict(item, recursive=recursive, depth=depth, **kwargs) 
-               for item in obj]
+        if isinstance(kwargs.get('fields'), dict):
+            obj = project_fields(obj, kwargs.get('fields'))
+        items, totals = obj, {}
+        if list_limits:
+            obj, sliced = slice_list_fields(obj, list_limits)
+            items = obj
+            # Tables don't report _list_totals, so don't pay for the aggregate
+            if sliced and kwargs.get('list_totals', True) and not kwargs.get('tabular'):
+                # One aggregate for the whole page rather than one per document
+                items = list(obj)
+                totals = list_field_totals(obj._document, [item.pk for item in items], sliced)
+        if kwargs.get('tabular'):
+            out = _tabular(items, obj._document, recursive, depth, ASSET_URL, kwargs)
+        else:
+            out = [object_to_dict(item, recursive=recursive, depth=depth,
+                                  _doc_list_totals=totals.get(item.pk), **kwargs)
+                   for item in items]
     elif isinstance(obj, ModuleType):
         out = None
     elif isinstance(obj, groupby):
@@ -211,14 +315,27 @@ def object_to_dict(obj=None, recursive=False, depth=1, **kwargs):
 
     elif isinstance(obj, (dict)):
         out = {}
+        list_totals = dict(list_totals or {})
+        spec = kwargs.get('fields')
         for k,v in obj.items():
             if kwargs.get('exclude_fields') and k in kwargs.get('exclude_fields'):
                 obj[k] = None
                 kwargs['delete_keys'].append(k)
                 continue
+            if spec is not None:
+                kwargs['fields'] = field_spec(spec, k)
+                if kwargs['fields'] is False:
+                    continue
+
+            if list_limits and k in list_limits and isinstance(v, list):
+                if len(v) > list_limits[k]:
+                    if kwargs.get('list_totals', True):
+                        list_totals.setdefault(k, len(v))
+                    v = v[:list_limits[k]]
 
             if k in kwargs.get('delete_keys'):
                 obj[k] = None
+            kwargs['current_field'] = k
             if k in kwargs.get('uri_fields'):
                 kwargs['apply_url_prefix'] = True
             else:
@@ -234,6 +351,9 @@ def object_to_dict(obj=None, recursive=False, depth=1, **kwargs):
             
             out[k] = vout
 
+        if list_totals:
+            out['_list_totals'] = list_totals
+
     elif isinstance(obj, bson.ObjectId):
         # out = {'ObjectId':str(obj)}
         out = str(obj)
@@ -249,7 +369,18 @@ def object_to_dict(obj=None, recursive=False, depth=1, **kwargs):
     elif isinstance(obj, Number):
         out = obj
     elif isinstance(obj, bson.DBRef):
-        if recursive:
+        # With a fields spec, only references with a nested spec are followed
+        spec = kwargs.get('fields')
+        follow = recursive if spec is None else isinstance(spec, dict)
+
+        orphans = get_orphan_cache(app) if kwargs.get('use_orphan_cache', True) else None
+        if follow and orphans is not None and orphans.is_orphan(obj.collection, obj.id):
+            # Known to be missing, so don't query (or log) it again
+            _count(stats, 'orphan_cache_hits')
+            _count(stats, 'orphans', obj.collection)
+            orphans.record(obj.collection, obj.id, kwargs.get('current_field'), app.logger)
+            out = None
+        elif follow:
             # We have to do a bit of lazy-loading here because the 
             # Mixin needs to know about the model class to load
             # which we could not have told it about before, due to circular
@@ -272,27 +403,69 @@ def object_to_dict(obj=None, recursive=False, depth=1, **kwargs):
                         if obj.collection == kwargs.get('deep_filter').keys()[0]:
                             filters.update(kwargs.get('deep_filter').values()[0])
                             
+                    # Filtered lookups can't be shared between references, so
+                    # only plain id-lookups go through the dereference cache
+                    deref_cache = kwargs.get('deref_cache')
+                    if kwargs.get('deep_filter') or kwargs.get('query_function'):
+                        deref_cache = None
+                    if deref_cache is not None:
+                        cache_key = (obj.collection, obj.id, bool(kwargs.get('use_derefs')),
+                                     json.dumps(spec, sort_keys=True))
+
                     query_function = 'objects'
-                    if kwargs.get('query_function'):
+                    queryset = None
+                    if deref_cache is not None and cache_key in deref_cache:
+                        doc, doc_totals = deref_cache[cache_key]
+                        _count(stats, 'deref_cache_hits')
+
+                    elif kwargs.get('query_function'):
                         query_function = kwargs.get('query_function').keys()[0]
                         filters.update(kwargs.get('query_function'))
-                        
-                        doc = getattr(Context, query_function)(**filters).first()
-                        
+
+                        queryset = getattr(Context, query_function)(**filters)
+
                     else:
+                        queryset = Context.objects(**filters)
                         # Only apply the deref_* filters if requested
-                        if kwargs.get('use_derefs'):
+                        if kwargs.get('use_derefs') and spec is None:
                             if hasattr(Context, 'deref_only_fields'):
-                                doc = Context.objects(**filters).only(*Context.deref_only_fields).first()
+                                queryset = queryset.only(*Context.deref_only_fields)
                             elif hasattr(Context, 'deref_exclude_fields'):
-                                doc = Context.objects(**filters).exclude(*Context.deref_exclude_fields).first()
-                            else:
-                                doc = Context.objects(**filters).first()
-                        else:
-                            doc = Context.objects(**filters).first()
-                        
+                                queryset = queryset.exclude(*Context.deref_exclude_fields)
+
+                    if queryset is not None:
+                        if spec is not None:
+                            queryset = project_fields(queryset, spec)
+                        query_options = get_query_options(app, obj.collection,
+                                                          kwargs.get('query_options'))
+                        queryset = apply_query_options(queryset, query_options)
+                        queryset, sliced = slice_list_fields(queryset, kwargs.get('list_limits'))
+                        started = time.time()
+                        doc = queryset.first()
+                        if stats is not None:
+                            _count(stats, 'derefs', obj.collection)
+                            _count(stats, 'deref_seconds', obj.collection, time.time() - started)
+                            if deref_cache is not None:
+                                _count(stats, 'deref_cache_misses')
+                        doc_totals = None
+                        if doc and sliced and kwargs.get('list_totals', True):
+                            doc_totals = list_field_totals(Context, [doc.pk], sliced,
+                                                           query_options).get(doc.pk)
+
+                        if deref_cache is not None:
+                            deref_cache[cache_key] = (doc, doc_totals)
+
                     if not doc:
-                        app.logger.error("Orphaned document: %s.id=%s" % (obj.collection, obj.id))
+                        _count(stats, 'orphans', obj.collection)
+                        if orphans is None:
+                            app.logger.error("Orphaned document: %s.id=%s" % (obj.collection, obj.id))
+                        else:
+                            app.logger.debug("Orphaned document: %s.id=%s" % (obj.collection, obj.id))
+                            # A filtered lookup may miss a document that does exist
+                            if not (kwargs.get('deep_filter') or kwargs.get('query_function')):
+                                orphans.add(obj.collection, obj.id)
+                            orphans.record(obj.collection, obj.id, kwargs.get('current_field'),
+                                           app.logger)
                         # Since this is an orphaned record, meaning it can't be decoded,
                         # don't send back a representation of it after logging
                         out = None
@@ -302,9 +475,16 @@ def object_to_dict(obj=None, recursive=False, depth=1, **kwargs):
                             doc = str(doc)
                         else:
                             if kwargs.get('current_depth') == depth:
-                                if doc: doc = doc._data
+                                # Copy, since the dict branch nulls excluded keys in-place
+                                # and the document may be shared through deref_cache
+                                if doc: doc = dict(doc._data)
                         
-                        out = object_to_dict(obj=doc, recursive=recursive, depth=depth, **kwargs)
+                        out = object_to_dict(obj=doc, recursive=recursive, depth=depth,
+                                             _doc_list_totals=doc_totals, **kwargs)
+                except ExecutionTimeout:
+                    # Degrade a slow reference to its stub rather than failing the response
+                    app.logger.warning("Dereference timed out: %s.id=%s" % (obj.collection, obj.id))
+                    out = {'collection': obj.collection, 'id': str(obj.id)}
                 except Exception as exc:
                     app.logger.error('Vars: context=%s, id=%s, depth=%s' % 
                                      (str(obj.collection), str(obj.id), depth),
@@ -321,6 +501,657 @@ def object_to_dict(obj=None, recursive=False, depth=1, **kwargs):
     
     return out
 
+def _count(stats, name, collection=None, value=1):
+    """Add to a per-call statistic, optionally per collection"""
+    if stats is None:
+        return
+    if collection is None:
+        stats[name] = stats.get(name, 0) + value
+    else:
+        counts = stats.setdefault(name, {})
+        counts[collection] = counts.get(collection, 0) + value
+
+def _observe_serialization(app, obj, recursive, depth, kwargs):
+    """Run a top-level object_to_dict, collecting its statistics into `metrics`
+    and profiling it if it is sampled or slow"""
+    kwargs['_stats'] = stats = {}
+    endpoint = request.endpoint if has_request_context() else None
+
+    profiler = None
+    sample_rate = app.config.get('MONGOUTILS_PROFILE_SAMPLE_RATE')
+    if sample_rate and random.random() < sample_rate:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    started = time.time()
+    try:
+        return object_to_dict(obj, recursive=recursive, depth=depth, **kwargs)
+    finally:
+        elapsed = time.time() - started
+        if profiler is not None:
+            profiler.disable()
+        if app.config.get('MONGOUTILS_METRICS'):
+            metrics.observe(endpoint or '', elapsed, stats)
+
+        slow_ms = app.config.get('MONGOUTILS_PROFILE_SLOW_MS')
+        if profiler is not None or (slow_ms and elapsed * 1000 >= slow_ms):
+            try:
+                _write_profile(app, profiler, obj, endpoint, elapsed, stats, kwargs)
+            except Exception:
+                app.logger.error("Could not write serialization profile", exc_info=True)
+
+# Keys in object_to_dict's kwargs that aren't worth recording in a profile
+_PROFILE_SKIP_OPTIONS = ('app', 'deref_cache', 'current_depth', 'current_field',
+                         'delete_keys', 'apply_url_prefix', '_stats')
+
+def _write_profile(app, profiler, obj, endpoint, elapsed, stats, kwargs):
+    """Write a serialization profile to MONGOUTILS_PROFILE_DIR
+
+    Sampled calls get a '<name>.prof' (loadable with pstats, snakeviz, flameprof,
+    ...) and every profiled call a '<name>.json' with the document, options,
+    latency and dereference timings. Only the newest MONGOUTILS_PROFILE_KEEP
+    profiles are kept.
+    """
+    directory = (app.config.get('MONGOUTILS_PROFILE_DIR') or
+                 os.path.join(tempfile.gettempdir(), 'mongoutils-profiles'))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    if isinstance(obj, Document):
+        target = {'model': obj.__class__.__name__, 'id': str(obj.pk)}
+    elif isinstance(obj, QuerySet):
+        target = {'model': obj._document.__name__, 'query': obj._query}
+    else:
+        target = {'type': type(obj).__name__}
+
+    name = '%s-%d-%06d' % (datetime.utcnow().strftime('%Y%m%dT%H%M%S%f'), os.getpid(),
+                            random.randint(0, 999999))
+    record = {'endpoint': endpoint, 'seconds': elapsed, 'sampled': profiler is not None,
+              'target': target, 'stats': stats,
+              'options': dict((k, v) for k, v in kwargs.items()
+                              if k not in _PROFILE_SKIP_OPTIONS)}
+    with open(os.path.join(directory, name + '.json'), 'w') as fh:
+        json.dump(record, fh, default=repr, indent=2)
+    if profiler is not None:
+        profiler.dump_stats(os.path.join(directory, name + '.prof'))
+
+    # Rotate: names start with the timestamp, so they sort oldest first
+    keep = app.config.get('MONGOUTILS_PROFILE_KEEP', 100)
+    names = sorted(set(os.path.splitext(f)[0] for f in os.listdir(directory)
+                       if f.endswith(('.json', '.prof'))))
+    for stale in names[:max(len(names) - keep, 0)]:
+        for ext in ('.json', '.prof'):
+            path = os.path.join(directory, stale + ext)
+            if os.path.exists(path):
+                os.remove(path)
+
+class SerializationMetrics(object):
+    """Process-wide counters and latency histograms for object_to_dict
+
+    Each top-level call collects its statistics without locking, and merges them
+    in here under a single (short) lock acquisition. Enabled with
+    MONGOUTILS_METRICS = True, and exported in the Prometheus text format by
+    render() or metrics_blueprint().
+    """
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    # Per-call statistic => (metric name, help, label for per-collection values)
+    COUNTERS = (
+        ('documents', 'mongoutils_documents_serialized_total',
+         'Documents serialized', None),
+        ('derefs', 'mongoutils_dereferences_total',
+         'Dereference queries', 'collection'),
+        ('deref_seconds', 'mongoutils_dereference_seconds_total',
+         'Time spent in dereference queries', 'collection'),
+        ('orphans', 'mongoutils_orphans_total',
+         'Orphaned references found', 'collection'),
+        ('deref_cache_hits', 'mongoutils_deref_cache_hits_total',
+         'Dereferences answered from deref_cache', None),
+        ('deref_cache_misses', 'mongoutils_deref_cache_misses_total',
+         'Dereferences not found in deref_cache', None),
+        ('orphan_cache_hits', 'mongoutils_orphan_cache_hits_total',
+         'Dereferences skipped as known orphans', None),
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # endpoint => [bucket counts..., +Inf count], sum
+            self._histograms = {}
+            self._sums = {}
+            # (statistic, endpoint, collection) => value
+            self._counters = {}
+
+    def observe(self, endpoint, seconds, stats):
+        bucket = bisect.bisect_left(self.BUCKETS, seconds)
+        with self._lock:
+            counts = self._histograms.get(endpoint)
+            if counts is None:
+                counts = self._histograms[endpoint] = [0] * (len(self.BUCKETS) + 1)
+            counts[bucket] += 1
+            self._sums[endpoint] = self._sums.get(endpoint, 0.0) + seconds
+            for name, value in stats.items():
+                if isinstance(value, dict):
+                    for collection, amount in value.items():
+                        key = (name, endpoint, collection)
+                        self._counters[key] = self._counters.get(key, 0) + amount
+                else:
+                    key = (name, endpoint, None)
+                    self._counters[key] = self._counters.get(key, 0) + value
+
+    def render(self):
+        """The metrics in the Prometheus text exposition format"""
+        with self._lock:
+            histograms = dict((k, list(v)) for k, v in self._histograms.items())
+            sums = dict(self._sums)
+            counters = dict(self._counters)
+
+        lines = ['# HELP mongoutils_serialization_seconds Top-level object_to_dict latency',
+                 '# TYPE mongoutils_serialization_seconds histogram']
+        for endpoint in sorted(histograms):
+            label = 'endpoint="%s"' % _escape_label(endpoint)
+            cumulative = 0
+            for le, count in zip([repr(b) for b in self.BUCKETS] + ['+Inf'], histograms[endpoint]):
+                cumulative += count
+                lines.append('mongoutils_serialization_seconds_bucket{%s,le="%s"} %d' %
+                             (label, le, cumulative))
+            lines.append('mongoutils_serialization_seconds_sum{%s} %r' % (label, sums[endpoint]))
+            lines.append('mongoutils_serialization_seconds_count{%s} %d' % (label, cumulative))
+
+        for name, metric, description, collection_label in self.COUNTERS:
+            lines.append('# HELP %s %s' % (metric, description))
+            lines.append('# TYPE %s counter' % metric)
+            for (stat, endpoint, collection), value in sorted(counters.items()):
+                if stat != name:
+                    continue
+                labels = 'endpoint="%s"' % _escape_label(endpoint)
+                if collection_label:
+                    labels += ',%s="%s"' % (collection_label, _escape_label(collection))
+                lines.append('%s{%s} %r' % (metric, labels, value))
+        return '\n'.join(lines) + '\n'
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+metrics = SerializationMetrics()
+
+def metrics_blueprint(url='/metrics', name='mongoutils_metrics'):
+    """A blueprint exposing `metrics` at `url` for Prometheus-compatible scrapers"""
+    blueprint = Blueprint(name, __name__)
+
+    @blueprint.route(url)
+    def serialization_metrics():
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    return blueprint
+
+def table_columns(doc_cls, exclude_fields=None, fields=None):
+    """The columns of a tabular serialization: the model's fields, id first,
+    in definition order, without excluded or private fields"""
+    names = getattr(doc_cls, '_fields_ordered', None) or sorted(
+        doc_cls._fields, key=lambda name: doc_cls._fields[name].creation_counter)
+    id_field = doc_cls._meta.get('id_field')
+    if id_field in names:
+        names = [id_field] + [name for name in names if name != id_field]
+
+    exclude_fields = exclude_fields or []
+    private_fields = getattr(doc_cls, '_PRIVATE_FIELDS', None) or []
+    spec = compile_fields(fields) if isinstance(fields, (list, tuple)) else fields
+    return [name for name in names
+            if name not in exclude_fields and name not in private_fields and
+            field_spec(spec, name) is not False]
+
+def _tabular(documents, doc_cls, recursive, depth, asset_url, kwargs):
+    """Serialize same-shaped documents into columns and rows of values, without
+    building an intermediate dict per document"""
+    columns = table_columns(doc_cls, kwargs.get('exclude_fields'), kwargs.get('fields'))
+    id_field = doc_cls._meta.get('id_field')
+    uri_fields = kwargs.get('uri_fields') or []
+    list_limits = kwargs.get('list_limits') or {}
+    prefix = asset_url if kwargs.get('asset_info') else None
+    stats = kwargs.get('_stats')
+
+    # Cells are one level down, as the fields of a serialized document would be
+    if recursive and kwargs.get('current_depth') >= depth:
+        recursive = False
+    else:
+        kwargs['current_depth'] += 1
+
+    spec = kwargs.get('fields')
+    cell_kwargs = []
+    for name in columns:
+        cell = dict(kwargs, current_field=name, apply_url_prefix=name in uri_fields)
+        cell.pop('tabular')
+        if spec is not None:
+            cell['fields'] = field_spec(spec, name)
+        cell_kwargs.append(cell)
+
+    by_column = kwargs.get('tabular') == 'columns'
+    rows = []
+    values = [[] for name in columns]
+    for doc in documents:
+        _count(stats, 'documents')
+        data = doc._data
+        row = [] if not by_column else None
+        for idx, name in enumerate(columns):
+            v = doc.pk if name == id_field else data.get(name)
+            if name in list_limits and isinstance(v, list):
+                v = v[:list_limits[name]]
+
+            # Plain values are handled inline, rather than with a call per cell
+            if v is None or isinstance(v, Number):
+                pass
+            elif isinstance(v, bson.ObjectId):
+                v = str(v)
+            elif isinstance(v, (str, unicode)):
+                if prefix and name in uri_fields and not v.startswith(prefix):
+                    v = "%s%s" % (prefix, v)
+            else:
+                v = object_to_dict(v, recursive=recursive, depth=depth, **cell_kwargs[idx])
+
+            if by_column:
+                values[idx].append(v)
+            else:
+                row.append(v)
+        if not by_column:
+            rows.append(row)
+
+    if by_column:
+        return {'columns': columns, 'data': dict(zip(columns, values))}
+    return {'columns': columns, 'rows': rows}
+
+def compile_fields(spec):
+    """Normalize a fields spec into {'name': 0 | 1 | {nested spec}}
+
+    The spec may be a dict, whose nested values may also be dicts or lists, or a
+    list of dotted paths, eg. ['title', 'author.name'] is the same as
+    {'title': 1, 'author': {'name': 1}}.
+
+    A level with any non-zero value is an inclusion: only its named keys (and id)
+    are emitted. A level with only zeros is an exclusion: all but those keys are.
+    """
+    if isinstance(spec, (list, tuple)):
+        compiled = {}
+        for path in spec:
+            node = compiled
+            names = path.split('.')
+            for name in names[:-1]:
+                if not isinstance(node.get(name), dict):
+                    node[name] = {}
+                node = node[name]
+            node.setdefault(names[-1], 1)
+        return compiled
+
+    if not isinstance(spec, dict):
+        raise ValueError("fields must be a dict or a list of dotted paths, not %r" % (spec,))
+
+    compiled = {}
+    for name, value in spec.items():
+        if isinstance(value, (dict, list, tuple)):
+            compiled[name] = compile_fields(value)
+        else:
+            compiled[name] = 1 if value else 0
+    return compiled
+
+def _spec_includes(spec):
+    """Whether a compiled spec level is an inclusion (rather than an exclusion)"""
+    return any(value != 0 for value in spec.values())
+
+def field_spec(spec, name):
+    """The spec for key `name` under a compiled spec
+
+    Returns:
+        False if the key is not emitted, True to emit it as-is (without following
+        references), or the nested spec dict. None and True specs are passed down.
+    """
+    if spec is None or spec is True:
+        return spec
+    value = spec.get(name)
+    if isinstance(value, dict):
+        return value
+    if name in spec and not value:
+        return False
+    if name not in spec and name not in ('id', None) and _spec_includes(spec):
+        return False
+    return True
+
+def project_fields(queryset, spec):
+    """Apply a compiled fields spec as an .only()/.exclude() projection"""
+    if not isinstance(spec, dict):
+        return queryset
+    doc_cls = queryset._document
+    names = [name for name in spec if name in doc_cls._fields]
+    if _spec_includes(spec):
+        only = [name for name in names if spec[name] != 0]
+        if only:
+            queryset = queryset.only(*only)
+    elif names:
+        queryset = queryset.exclude(*names)
+    return queryset
+
+def get_query_options(app, collection, query_options=None):
+    """Merge the MONGOUTILS_QUERY_OPTIONS config and `query_options` for a collection"""
+    options = {}
+    for source in (app.config.get('MONGOUTILS_QUERY_OPTIONS'), query_options):
+        if source:
+            options.update(source.get('*') or {})
+            options.update(source.get(collection) or {})
+    return options
+
+def _read_preference(value):
+    """A pymongo read preference, from itself or its name, eg. 'secondary'"""
+    if isinstance(value, basestring):
+        return getattr(ReadPreference, value.upper())
+    return value
+
+def apply_query_options(queryset, options):
+    """Apply read_preference, hint, max_time_ms, batch_size and no_cursor_timeout
+
+    read_preference may be a pymongo read preference or its name, eg. 'secondary'.
+    max_time_ms requires a mongoengine with QuerySet.max_time_ms (0.10+).
+    """
+    if not options:
+        return queryset
+
+    read_preference = _read_preference(options.get('read_preference'))
+    if read_preference is not None:
+        queryset = queryset.read_preference(read_preference)
+    if options.get('hint') is not None:
+        queryset = queryset.hint(options['hint'])
+    if options.get('max_time_ms'):
+        queryset = queryset.max_time_ms(options['max_time_ms'])
+    if options.get('batch_size'):
+        queryset = queryset.batch_size(options['batch_size'])
+    if options.get('no_cursor_timeout'):
+        queryset = queryset.timeout(False)
+    return queryset
+
+def slice_list_fields(queryset, list_limits):
+    """Push `list_limits` down to the queryset as $slice projections
+
+    Returns:
+        The (possibly) sliced queryset and the names of the sliced fields
+    """
+    if not list_limits:
+        return queryset, []
+
+    doc_cls = queryset._document
+    sliced = [name for name in list_limits
+              if isinstance(doc_cls._fields.get(name), ListField)]
+    if sliced:
+        queryset = queryset.fields(**dict(('slice__%s' % name, list_limits[name])
+                                          for name in sliced))
+    return queryset, sliced
+
+def list_field_totals(doc_cls, ids, names, query_options=None):
+    """Fetch the full length of list fields for the given documents
+
+    Kwargs:
+        query_options (dict): read_preference, max_time_ms and hint for the
+            aggregate, as for apply_query_options
+
+    Returns:
+        {id: {'field-name': length}}
+    """
+    if not ids or not names:
+        return {}
+
+    query_options = query_options or {}
+    collection = doc_cls._get_collection()
+    aggregate_args = {}
+    read_preference = _read_preference(query_options.get('read_preference'))
+    if read_preference is not None:
+        # pymongo < 3 takes the read preference per command
+        if hasattr(collection, 'with_options'):
+            collection = collection.with_options(read_preference=read_preference)
+        else:
+            aggregate_args['read_preference'] = read_preference
+    if query_options.get('max_time_ms'):
+        aggregate_args['maxTimeMS'] = query_options['max_time_ms']
+    if query_options.get('hint') is not None:
+        aggregate_args['hint'] = query_options['hint']
+
+    project = dict((name, {'$size': {'$ifNull': ['$%s' % doc_cls._fields[name].db_field, []]}})
+                   for name in names)
+    result = collection.aggregate([{'$match': {'_id': {'$in': ids}}},
+                                   {'$project': project}], **aggregate_args)
+    # pymongo < 3 returns the whole response rather than a cursor
+    rows = result.get('result', []) if isinstance(result, dict) else result
+    return dict((row['_id'], dict((name, row.get(name)) for name in names))
+                for row in rows)
+
+def _reference_paths(doc_cls, exclude_fields=None, prefix=(), containers=0):
+    """Yield (path, referenced-class, many, containers) for every reference in a
+    model schema
+
+    Embedded documents are walked (they don't cost a query), and the referenced
+    class is None for GenericReferenceFields. `containers` counts the lists and
+    embedded documents between the document and the reference, each of which is
+    one more object_to_dict call (and level of `depth`).
+    """
+    exclude_fields = exclude_fields or []
+    private_fields = getattr(doc_cls, '_PRIVATE_FIELDS', None) or []
+    for name, field in doc_cls._fields.items():
+        if name in exclude_fields or name in private_fields:
+            continue
+        many = isinstance(field, ListField)
+        inner = field.field if many else field
+        if isinstance(inner, ReferenceField):
+            yield prefix + (name,), inner.document_type, many, containers + many
+        elif isinstance(inner, GenericReferenceField):
+            yield prefix + (name,), None, many, containers + many
+        elif isinstance(inner, EmbeddedDocumentField):
+            for item in _reference_paths(inner.document_type, exclude_fields, prefix + (name,),
+                                         containers + many + 1):
+                yield item
+
+def _child_depth(current_depth, depth):
+    """The current_depth object_to_dict passes to the children of a (container)
+    call made with `current_depth`, or None once recursion has stopped"""
+    if current_depth is None or (current_depth > 0 and current_depth >= depth):
+        return None
+    return current_depth + 1
+
+def _collect_refs(obj, path, list_limits, refs):
+    """Append the raw references found under `path` in obj to `refs`"""
+    name, rest = path[0], path[1:]
+    value = getattr(obj, '_data', {}).get(name)
+    values = value if isinstance(value, list) else [value]
+    if isinstance(value, list) and name in list_limits:
+        values = values[:list_limits[name]]
+    for item in values:
+        if item is None:
+            continue
+        if rest:
+            _collect_refs(item, rest, list_limits, refs)
+        else:
+            refs.append(item)
+
+def _ref_id(ref):
+    """The referenced id of a DBRef, dereferenced document or generic reference"""
+    if isinstance(ref, bson.DBRef):
+        return ref.id
+    if isinstance(ref, Document):
+        return ref.pk
+    if isinstance(ref, dict):
+        ref = ref.get('_ref')
+        return ref.id if ref is not None else None
+    return ref
+
+def _deref_queryset(doc_cls, ids, spec=None, **kwargs):
+    """Build the queryset object_to_dict would use to dereference `ids` of doc_cls"""
+    filters = {'id__in': ids}
+    for collection, deep_filter in (kwargs.get('deep_filter') or {}).items():
+        if collection == doc_cls._get_collection_name():
+            filters.update(deep_filter)
+
+    queryset = doc_cls.objects(**filters)
+    projection = {}
+    if spec is not None:
+        queryset = project_fields(queryset, spec)
+        names = [name for name in spec if name in doc_cls._fields]
+        if _spec_includes(spec):
+            projection['only'] = [name for name in names if spec[name] != 0]
+        elif names:
+            projection['exclude'] = names
+    elif kwargs.get('use_derefs'):
+        if hasattr(doc_cls, 'deref_only_fields'):
+            queryset = queryset.only(*doc_cls.deref_only_fields)
+            projection['only'] = list(doc_cls.deref_only_fields)
+        elif hasattr(doc_cls, 'deref_exclude_fields'):
+            queryset = queryset.exclude(*doc_cls.deref_exclude_fields)
+            projection['exclude'] = list(doc_cls.deref_exclude_fields)
+    queryset, sliced = slice_list_fields(queryset, kwargs.get('list_limits'))
+    if sliced:
+        projection['slice'] = dict((name, kwargs['list_limits'][name]) for name in sliced)
+    return queryset, projection or None, sliced
+
+def _uses_collscan(queryset):
+    """Whether MongoDB would answer the queryset with a full collection scan"""
+    try:
+        plan = repr(queryset.explain())
+    except Exception:
+        return None
+    # 'BasicCursor' is how MongoDB < 3.0 reports a collection scan
+    return 'COLLSCAN' in plan or 'BasicCursor' in plan
+
+def explain_serialization(queryset_or_doc, recursive=False, depth=1, sample_size=20, **kwargs):
+    """Estimate what object_to_dict would cost, without serializing anything
+
+    Walks the model schema for references (ReferenceField, ListField(ReferenceField),
+    GenericReferenceField, also inside embedded documents) and samples the data to
+    estimate how many dereference queries object_to_dict would issue per collection
+    and level, and how many documents those would fetch.
+
+    Args:
+        queryset_or_doc: The QuerySet or Document that would be serialized
+
+    Kwargs:
+        recursive, depth, fields, exclude_fields, use_derefs, deep_filter,
+        query_function, types_as_str_repr, list_limits, list_totals:
+            As for object_to_dict
+        sample_size (int): Number of documents to sample at each level
+
+    Returns:
+        {'model': 'Book', 'documents': 100, 'levels': 1, 'queries': 201.0,
+         'root': {'collscan': False, 'query': {...}},
+         'collections': {'author': {'queries': 100.0, 'documents': 98.0,
+                                    'by_level': {1: 100.0}}, ...},
+         'dereferences': [{'level': 1, 'path': 'author', 'collection': 'author',
+                           'model': 'Author', 'per_document': 1.0, 'queries': 100.0,
+                           'documents': 98.0, 'found_ratio': 0.98,
+                           'projection': None, 'aggregates': 0.0,
+                           'index': '_id_'}, ...]}
+    """
+    list_limits = kwargs.get('list_limits') or {}
+    list_totals = kwargs.get('list_totals', True)
+    spec = compile_fields(kwargs.pop('fields')) if kwargs.get('fields') is not None else None
+
+    # Mirrors object_to_dict, whose QuerySet, list, document and embedded document
+    # calls each take a level of `depth`: track the current_depth the fields of
+    # each sampled document are serialized with. A fields spec ignores depth.
+    children_depth = _child_depth(0, depth) if recursive else None
+
+    if isinstance(queryset_or_doc, QuerySet):
+        children_depth = _child_depth(children_depth, depth)
+        doc_cls = queryset_or_doc._document
+        documents = queryset_or_doc.count(with_limit_and_skip=True)
+        root_qs, sliced = slice_list_fields(project_fields(queryset_or_doc.clone(), spec),
+                                            list_limits)
+        sample = list(root_qs.limit(min(sample_size, documents or 1)))
+        queries = 1.0 + (1 if sliced and list_totals else 0)
+        root = {'query': root_qs._query, 'collscan': _uses_collscan(root_qs)}
+    else:
+        doc_cls = queryset_or_doc.__class__
+        documents = 1
+        sample = [queryset_or_doc]
+        queries = 0.0
+        root = None
+
+    report = {'model': doc_cls.__name__, 'documents': documents, 'levels': 0,
+              'sampled': len(sample), 'root': root, 'collections': {},
+              'dereferences': []}
+
+    current = [(doc_cls, sample, float(documents), '', spec, children_depth)]
+    level = 0
+    while current:
+        level += 1
+        following = []
+        for parent_cls, parent_sample, parent_count, parent_path, parent_spec, parent_depth in current:
+            if not parent_sample:
+                continue
+            for path, target_cls, many, containers in _reference_paths(
+                    parent_cls, kwargs.get('exclude_fields')):
+                child_spec = parent_spec
+                for name in path:
+                    child_spec = field_spec(child_spec, name)
+                    if child_spec is False:
+                        break
+                if spec is not None:
+                    if not isinstance(child_spec, dict):
+                        # Not emitted, or emitted as a reference stub
+                        continue
+                    doc_depth = None
+                else:
+                    ref_depth = parent_depth
+                    for _ in range(containers):
+                        ref_depth = _child_depth(ref_depth, depth)
+                    if ref_depth is None or ref_depth >= depth:
+                        # Emitted as a reference stub
+                        continue
+                    # The dereferenced document is serialized with ref_depth + 1
+                    doc_depth = _child_depth(ref_depth + 1, depth)
+
+                report['levels'] = level
+                refs = []
+                for item in parent_sample:
+                    _collect_refs(item, path, list_limits, refs)
+                per_document = float(len(refs)) / len(parent_sample)
+                lookups = parent_count * per_document
+                dotted = '.'.join(filter(None, [parent_path] + list(path)))
+                entry = {'level': level, 'path': dotted, 'many': many,
+                         'per_document': round(per_document, 2),
+                         'queries': round(lookups, 2), 'aggregates': 0.0,
+                         'projection': None, 'found_ratio': None,
+                         'documents': None, 'collection': None, 'model': None,
+                         'index': None if kwargs.get('query_function') else '_id_'}
+
+                if target_cls is not None:
+                    collection = target_cls._get_collection_name()
+                    ids = [i for i in set(_ref_id(ref) for ref in refs) if i is not None][:sample_size]
+                    queryset, projection, sliced = _deref_queryset(target_cls, ids, child_spec,
+                                                                   **kwargs)
+                    found = list(queryset) if ids else []
+                    found_ratio = float(len(found)) / len(ids) if ids else 1.0
+                    fetched = lookups * found_ratio
+
+                    entry.update({'collection': collection, 'model': target_cls.__name__,
+                                  'projection': projection,
+                                  'found_ratio': round(found_ratio, 2),
+                                  'documents': round(fetched, 2)})
+                    if sliced and list_totals:
+                        entry['aggregates'] = round(fetched, 2)
+
+                    stats = report['collections'].setdefault(
+                        collection, {'queries': 0.0, 'documents': 0.0, 'by_level': {}})
+                    stats['queries'] += lookups + entry['aggregates']
+                    stats['documents'] += fetched
+                    stats['by_level'][level] = stats['by_level'].get(level, 0.0) + lookups
+
+                    if target_cls.__name__ not in (kwargs.get('types_as_str_repr') or []):
+                        following.append((target_cls, found, fetched, dotted, child_spec,
+                                          doc_depth))
+
+                queries += lookups + entry['aggregates']
+                report['dereferences'].append(entry)
+        current = following
+
+    report['queries'] = round(queries, 2)
+    return report
+
 def lazy_load_model_classes(app, collection, model_map=None):
     """Lazily load modules as necessary"""
     # Ref: http://stackoverflow.com/questions/3372361/dynamic-loading-of-modules-then-using-from-x-import-on-loaded-module
@@ -378,3 +1209,491 @@ def lazy_load_model_classes(app, collection, model_map=None):
                          exc_info=True)
 
     return classname 
+
+
+class OrphanCache(object):
+    """Bounded, expiring record of references to documents known to be missing
+
+    Dereferencing an orphaned reference costs a query that finds nothing, on every
+    request that touches it. Known-missing (collection, id) pairs are remembered
+    for `ttl` seconds (least recently found are dropped beyond `size`) so repeats
+    are skipped without a query.
+
+    Occurrences are also counted per collection and field, and instead of logging
+    each one, a summary is logged every `report_interval` seconds (by a timer
+    started with the first occurrence since the last summary).
+    """
+    SAMPLE_IDS = 5
+
+    def __init__(self, size=10000, ttl=300, report_interval=60):
+        self.size = size
+        self.ttl = ttl
+        self.report_interval = report_interval
+        self._missing = OrderedDict()
+        self._counts = {}
+        self._samples = {}
+        self._last_report = time.time()
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def is_orphan(self, collection, id):
+        with self._lock:
+            expires = self._missing.get((collection, id))
+            if expires is None:
+                return False
+            if expires < time.time():
+                self._missing.pop((collection, id), None)
+                return False
+            return True
+
+    def add(self, collection, id):
+        with self._lock:
+            self._missing.pop((collection, id), None)
+            self._missing[(collection, id)] = time.time() + self.ttl
+            while len(self._missing) > self.size:
+                self._missing.popitem(last=False)
+
+    def record(self, collection, id, field=None, logger=None):
+        """Count an occurrence of an orphaned reference, and schedule a summary"""
+        key = (collection, field)
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + 1
+            samples = self._samples.setdefault(key, [])
+            if len(samples) < self.SAMPLE_IDS and str(id) not in samples:
+                samples.append(str(id))
+
+            # Log the summary when the interval is up, even if no orphans follow
+            if logger is not None and self._timer is None:
+                delay = max(self.report_interval - (time.time() - self._last_report), 0)
+                self._timer = threading.Timer(delay, self.flush, [logger])
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self, logger):
+        """Log and reset the counts gathered since the last summary"""
+        with self._lock:
+            self._timer = None
+        report = self.report(reset=True)
+        if report:
+            logger.error("Orphaned references in the last %ds: %s" %
+                         (self.report_interval, report))
+
+    def report(self, reset=False):
+        """Orphan counts since the last reset
+
+        Returns:
+            {'collection': {'field-name': {'count': 12, 'sample_ids': [...]}}}
+        """
+        with self._lock:
+            out = {}
+            for (collection, field), count in self._counts.items():
+                out.setdefault(collection, {})[field] = {
+                    'count': count, 'sample_ids': list(self._samples.get((collection, field), []))}
+            if reset:
+                self._counts = {}
+                self._samples = {}
+                self._last_report = time.time()
+        return out
+
+def get_orphan_cache(app):
+    """The app's OrphanCache, or None if disabled with MONGOUTILS_ORPHAN_CACHE_SIZE = 0"""
+    extensions = app.extensions
+    if 'mongoutils_orphans' not in extensions:
+        size = app.config.get('MONGOUTILS_ORPHAN_CACHE_SIZE', 10000)
+        extensions['mongoutils_orphans'] = size and OrphanCache(
+            size=size,
+            ttl=app.config.get('MONGOUTILS_ORPHAN_CACHE_TTL', 300),
+            report_interval=app.config.get('MONGOUTILS_ORPHAN_REPORT_INTERVAL', 60)) or None
+    return extensions['mongoutils_orphans']
+
+def orphan_report(app=None, reset=False):
+    """Orphaned references seen by the app (default: current_app) since the last report"""
+    orphans = get_orphan_cache(app or current_app)
+    return orphans.report(reset=reset) if orphans is not None else {}
+
+class SnapshotStore(object):
+    """Serialized documents, stored in a side collection and maintained on write
+
+    For the most-read documents, the output of object_to_dict can be stored per
+    model and option profile, and served with one indexed find and no
+    dereferencing. Snapshots are refreshed from mongoengine's post_save and
+    post_delete signals, both for the document itself and for the documents it
+    references (up to the profile's depth). Requires blinker.
+
+        snapshots = SnapshotStore(app)
+        snapshots.register(Book, 'api', recursive=True, depth=2, uri_fields=['uri'])
+        ...
+        data = snapshots.get(Book, book_id, 'api')
+
+    Existing documents are backfilled with rebuild(), or from the command line:
+
+        python -m flask_mongoutils snapshots-rebuild myproj:create_app myproj.snapshots:store
+    """
+
+    def __init__(self, app=None, collection='mongoutils_snapshots'):
+        self.app = None
+        self.collection = collection
+        self.profiles = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['mongoutils_snapshots'] = self
+
+    def register(self, model, profile='default', **options):
+        """Maintain snapshots of `model` serialized with the object_to_dict `options`"""
+        if not signals.signals_available:
+            raise Exception("SnapshotStore needs blinker for mongoengine signals")
+        if not self.profiles:
+            signals.post_save.connect(self._on_save)
+            signals.post_delete.connect(self._on_delete)
+        self.profiles[(model.__name__, profile)] = (model, options)
+
+    def close(self):
+        """Stop maintaining snapshots: drop the profiles and disconnect the signals"""
+        if self.profiles:
+            signals.post_save.disconnect(self._on_save)
+            signals.post_delete.disconnect(self._on_delete)
+        self.profiles = {}
+        if self.app is not None and self.app.extensions.get('mongoutils_snapshots') is self:
+            del self.app.extensions['mongoutils_snapshots']
+
+    def _collection(self, model):
+        return model._get_db()[self.collection]
+
+    def _key(self, model, profile, doc_id):
+        return '%s:%s:%s' % (model.__name__, profile, doc_id)
+
+    def get(self, model, doc_id, profile='default'):
+        """The stored snapshot of a document, or None"""
+        snapshot = self._collection(model).find_one({'_id': self._key(model, profile, doc_id)})
+        return snapshot.get('data') if snapshot else None
+
+    def refresh(self, doc, profile=None, reload=True):
+        """Re-serialize and store a document for its (or one) registered profile
+
+        Kwargs:
+            reload (bool): Load the document from the database first. An in-memory
+                instance (eg. from post_save) may hold referenced documents rather
+                than DBRefs, which object_to_dict would embed whole regardless of
+                depth or projection.
+        """
+        for (name, profile_name), (model, options) in self.profiles.items():
+            if name != doc.__class__.__name__ or profile not in (None, profile_name):
+                continue
+            if reload:
+                doc = model.objects(pk=doc.pk).first()
+                reload = False
+                if doc is None:
+                    return
+            # Snapshots don't expire, so don't trust recently cached orphans
+            data = object_to_dict(doc, app=self.app, **dict(options, use_orphan_cache=False))
+            snapshot = {'_id': self._key(model, profile_name, doc.pk), 'model': name,
+                        'profile': profile_name, 'doc_id': doc.pk, 'data': data,
+                        'updated': datetime.utcnow()}
+            collection = self._collection(model)
+            # pymongo < 3 has no replace_one
+            if hasattr(collection, 'replace_one'):
+                collection.replace_one({'_id': snapshot['_id']}, snapshot, upsert=True)
+            else:
+                collection.update({'_id': snapshot['_id']}, snapshot, upsert=True)
+
+    def remove(self, doc):
+        """Drop all snapshots of a document"""
+        for (name, profile_name), (model, options) in self.profiles.items():
+            if name == doc.__class__.__name__:
+                collection = self._collection(model)
+                key = self._key(model, profile_name, doc.pk)
+                if hasattr(collection, 'delete_one'):
+                    collection.delete_one({'_id': key})
+                else:
+                    collection.remove({'_id': key})
+
+    def rebuild(self, model=None, profile=None):
+        """Backfill snapshots of all documents, optionally of one model or profile
+
+        Returns:
+            Number of snapshots written
+        """
+        count = 0
+        for (name, profile_name), (model_cls, options) in self.profiles.items():
+            if model not in (None, name, model_cls) or profile not in (None, profile_name):
+                continue
+            for doc in model_cls.objects:
+                self.refresh(doc, profile_name, reload=False)
+                count += 1
+        return count
+
+    def _dependents(self, model, options, changed):
+        """Documents of `model` whose snapshot (for `options`) includes `changed`"""
+        fields = options.get('fields')
+        if fields is not None:
+            levels = _spec_depth(compile_fields(fields))
+        else:
+            levels = max(options.get('depth', 1) - 1, 0) if options.get('recursive') else 0
+
+        # Chains of (class, reference path) from the model down to the changed class
+        chains, frontier = [], [(model, [])]
+        for level in range(levels):
+            following = []
+            for cls, chain in frontier:
+                for path, target_cls, many, containers in _reference_paths(
+                        cls, options.get('exclude_fields')):
+                    if target_cls is None:
+                        continue
+                    step = chain + [(cls, '__'.join(path))]
+                    if isinstance(changed, target_cls):
+                        chains.append(step)
+                    following.append((target_cls, step))
+            frontier = following
+
+        # Walk each chain back up from the changed document, one query per step
+        dependents = {}
+        for chain in chains:
+            ids = [changed.pk]
+            for cls, path in reversed(chain):
+                if not ids:
+                    break
+                ids = [doc.pk for doc in cls.objects(**{'%s__in' % path: ids}).only('id')]
+            for doc in model.objects(id__in=ids) if ids else []:
+                dependents[doc.pk] = doc
+        return dependents.values()
+
+    def _on_save(self, sender, document, **kwargs):
+        self._on_write(document, deleted=False)
+
+    def _on_delete(self, sender, document, **kwargs):
+        self._on_write(document, deleted=True)
+
+    def _on_write(self, document, deleted):
+        try:
+            if deleted:
+                self.remove(document)
+            else:
+                self.refresh(document)
+            # Referencing documents now embed a changed (or orphaned) reference
+            for (name, profile_name), (model, options) in self.profiles.items():
+                for dependent in self._dependents(model, options, document):
+                    self.refresh(dependent, profile_name, reload=False)
+        except Exception:
+            # Never fail the write itself; rebuild() can repair the snapshots
+            self.app.logger.error("Could not refresh snapshots of %s.id=%s" %
+                                  (document.__class__.__name__, document.pk), exc_info=True)
+
+def _spec_depth(spec):
+    """How many levels of references a compiled fields spec can follow"""
+    nested = [_spec_depth(value) for value in spec.values() if isinstance(value, dict)]
+    return 1 + max(nested) if nested else 0
+
+# Maximum number of dereferenced documents an export worker keeps cached
+EXPORT_DEREF_CACHE_SIZE = 10000
+
+# Per-process state for export workers. Each worker builds its own app,
+# connection and dereference cache in _export_worker_init
+_export_worker = {}
+
+def _import_object(path):
+    """Import 'package.module:name' (or 'package.module.name') and return name"""
+    if ':' in path:
+        module_name, attr = path.split(':', 1)
+    else:
+        module_name, attr = path.rsplit('.', 1)
+    module = __import__(module_name, fromlist=[attr])
+    return getattr(module, attr)
+
+def _export_worker_init(app_factory, model_path, app_name=None):
+    """Set up a forked export worker with its own connection and caches"""
+    from mongoengine.base.common import _document_registry
+    from mongoengine.connection import disconnect
+
+    # Connections (and the collections cached on the document classes) are
+    # inherited from the parent on fork and must not be shared across processes
+    disconnect()
+    for doc_cls in _document_registry.values():
+        doc_cls._collection = None
+
+    app = _import_object(app_factory)()
+    if app_name:
+        app.name = app_name
+    _export_worker['app'] = app
+    _export_worker['model'] = _import_object(model_path)
+    _export_worker['deref_cache'] = {}
+
+def _export_range(task):
+    """Serialize one _id range of the collection into an NDJSON part file"""
+    path, lower, upper, options = task
+    app = _export_worker['app']
+    model = _export_worker['model']
+    deref_cache = _export_worker['deref_cache']
+
+    filters = {}
+    if lower is not None:
+        filters['id__gte'] = lower
+    if upper is not None:
+        filters['id__lt'] = upper
+
+    count = 0
+    with app.app_context():
+        with open(path, 'w') as fh:
+            for doc in model.objects(**filters).order_by('id'):
+                # Keep memory bounded, within a range as well as across ranges
+                if len(deref_cache) > EXPORT_DEREF_CACHE_SIZE:
+                    deref_cache.clear()
+                data = object_to_dict(doc, app=app, deref_cache=deref_cache, **options)
+                fh.write(json.dumps(data, default=str))
+                fh.write('\n')
+                count += 1
+    return count
+
+def _id_ranges(model, chunks):
+    """Split a collection into roughly equal [lower, upper) _id ranges"""
+    total = model.objects.count()
+    if chunks <= 1 or total <= chunks:
+        return [(None, None)]
+
+    step = total // chunks
+    bounds = []
+    # One pass over the _id index, rather than a skip() (and index scan) per boundary
+    cursor = model._get_collection().find({}, {'_id': 1}).sort('_id', 1).batch_size(10000)
+    for idx, row in enumerate(cursor):
+        if idx and idx % step == 0:
+            bounds.append(row['_id'])
+            if len(bounds) == chunks - 1:
+                break
+    cursor.close()
+
+    edges = [None] + bounds + [None]
+    return list(zip(edges[:-1], edges[1:]))
+
+def export_collection(app_factory, model_path, output, processes=None, chunks=None,
+                      sharded=False, app_name=None, recursive=True, depth=1, **kwargs):
+    """Serialize a whole collection to NDJSON using a pool of worker processes
+
+    The collection is split into `_id` ranges which are serialized in parallel
+    through object_to_dict. Each worker builds its own app (and therefore its own
+    connection), model registry and dereference cache.
+
+    Args:
+        app_factory (str): Import path of the app factory, eg. 'myproj:create_app'
+        model_path (str): Import path of the model, eg. 'myproj.book.models:Book'
+        output (str): Output file. When `sharded`, one file is written per range
+            as '<output>-00000.ndjson', '<output>-00001.ndjson', ...
+
+    Kwargs:
+        processes (int): Number of worker processes. Defaults to the number of cores
+        chunks (int): Number of _id ranges to split into. Defaults to 4 * processes
+        sharded (bool): Write one file per range instead of a single ordered file
+        app_name (str): Override app.name in the workers (used for model lazy-loading)
+        depth, recursive, exclude_fields, uri_fields, model_map, ...:
+            Passed through to object_to_dict
+
+    Returns:
+        List of the files written and the number of documents exported
+    """
+    processes = processes or multiprocessing.cpu_count()
+    chunks = chunks or processes * 4
+
+    app = _import_object(app_factory)()
+    model = _import_object(model_path)
+    with app.app_context():
+        ranges = _id_ranges(model, chunks)
+
+    kwargs.update({'recursive': recursive, 'depth': depth})
+    base = re.sub(r'\.ndjson$', '', output)
+    tasks = []
+    for idx, (lower, upper) in enumerate(ranges):
+        if sharded:
+            path = "%s-%05d.ndjson" % (base, idx)
+        else:
+            path = "%s.part-%05d" % (output, idx)
+        tasks.append((path, lower, upper, dict(kwargs)))
+
+    paths = [task[0] for task in tasks]
+    try:
+        pool = multiprocessing.Pool(processes, _export_worker_init,
+                                    (app_factory, model_path, app_name))
+        try:
+            # imap keeps the results in range order, so part files can be concatenated
+            total = sum(pool.imap(_export_range, tasks))
+        finally:
+            pool.terminate()
+            pool.join()
+
+        if not sharded:
+            with open(output, 'w') as out:
+                for path in paths:
+                    with open(path) as part:
+                        shutil.copyfileobj(part, out)
+    finally:
+        # Part files are only intermediate, whether or not the export succeeded
+        if not sharded:
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    if not sharded:
+        paths = [output]
+    return paths, total
+
+def main(argv=None):
+    """Command-line entry point, eg.
+
+        python -m flask_mongoutils export myproj:create_app \\
+            myproj.book.models:Book books.ndjson --depth 2 --processes 8
+    """
+    parser = argparse.ArgumentParser(prog='flask_mongoutils',
+                                     description='Flask-MongoUtils command-line tools')
+    subparsers = parser.add_subparsers(dest='command')
+
+    export = subparsers.add_parser('export', help='Export a collection to NDJSON')
+    export.add_argument('app_factory', help="App factory, eg. 'myproj:create_app'")
+    export.add_argument('model', help="Model class, eg. 'myproj.book.models:Book'")
+    export.add_argument('output', help='Output file (or prefix when --sharded)')
+    export.add_argument('--processes', type=int, default=None)
+    export.add_argument('--chunks', type=int, default=None)
+    export.add_argument('--sharded', action='store_true',
+                        help='Write one file per _id range instead of one ordered file')
+    export.add_argument('--app-name', default=None,
+                        help='Override app.name, used when lazy-loading models')
+    export.add_argument('--depth', type=int, default=1)
+    export.add_argument('--exclude-fields', default='', help='Comma-separated field names')
+    export.add_argument('--uri-fields', default='', help='Comma-separated field names')
+    export.add_argument('--model-map', default=None,
+                        help='JSON mapping, eg. \'{"Publisher": "modules.publisher"}\'')
+
+    rebuild = subparsers.add_parser('snapshots-rebuild',
+                                    help='Backfill the snapshots of a SnapshotStore')
+    rebuild.add_argument('app_factory', help="App factory, eg. 'myproj:create_app'")
+    rebuild.add_argument('store', help="SnapshotStore, eg. 'myproj.snapshots:store'")
+    rebuild.add_argument('--model', default=None, help='Only rebuild this model (class name)')
+    rebuild.add_argument('--profile', default=None, help='Only rebuild this profile')
+    rebuild.add_argument('--app-name', default=None,
+                         help='Override app.name, used when lazy-loading models')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'export':
+        paths, total = export_collection(
+            args.app_factory, args.model, args.output,
+            processes=args.processes, chunks=args.chunks, sharded=args.sharded,
+            app_name=args.app_name, depth=args.depth,
+            exclude_fields=[f for f in args.exclude_fields.split(',') if f],
+            uri_fields=[f for f in args.uri_fields.split(',') if f],
+            model_map=json.loads(args.model_map) if args.model_map else None)
+        sys.stdout.write("Exported %d documents to %s\n" % (total, ', '.join(paths)))
+
+    elif args.command == 'snapshots-rebuild':
+        app = _import_object(args.app_factory)()
+        if args.app_name:
+            app.name = args.app_name
+        store = _import_object(args.store)
+        if store.app is None:
+            store.init_app(app)
+        with app.app_context():
+            count = store.rebuild(model=args.model, profile=args.profile)
+        sys.stdout.write("Rebuilt %d snapshots\n" % count)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,6 +5,7 @@ class Book(db.Document):
     title = db.StringField()
     author = db.ReferenceField('Author')
     publisher = db.ReferenceField('Publisher')
+    tags = db.ListField(db.StringField())
 
     def as_dict(self, **kwargs):
         resp = object_to_dict(self, **kwargs)
@@ -29,6 +29,9 @@ setup(
     zip_safe=False,
     platforms='any',
     install_requires=['Flask'],
+    entry_points={
+        'console_scripts': ['mongoutils = flask_mongoutils:main'],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Environment :: Web Environment',
@@ -36,7 +36,8 @@ class ObjectToDictTestCase(unittest.TestCase):
         author.save()
         publisher = Publisher(name='testpub')
         publisher.save()
-        book = Book(author=author, publisher=publisher, title='testbook')
+        book = Book(author=author, publisher=publisher, title='testbook',
+                    tags=['a', 'b', 'c', 'd', 'e'])
         book.save()
 
     def tearDown(self):
@@ -92,6 +93,315 @@ class ObjectToDictTestCase(unittest.TestCase):
             self.assertTrue(bdata.get('author').get('private') is None)
             self.assertTrue(bdata.get('author').get('excluded') is None)
 
+    def test_list_limits(self):
+        from flask_mongoutils import object_to_dict
+        with self.app.app_context():
+            book = Book.objects.first()
+            bdata = book.as_dict(app=current_app, list_limits={'tags': 2})
+            self.assertEqual(['a', 'b'], bdata.get('tags'))
+            self.assertEqual({'tags': 5}, bdata.get('_list_totals'))
+
+            # QuerySets get the limit pushed down as a $slice projection
+            data = object_to_dict(Book.objects, app=current_app, list_limits={'tags': 3})
+            self.assertEqual(['a', 'b', 'c'], data[0].get('tags'))
+            self.assertEqual({'tags': 5}, data[0].get('_list_totals'))
+
+    def test_list_totals(self):
+        from flask_mongoutils import object_to_dict
+        with self.app.app_context():
+            book = Book.objects.first()
+            # Lists within their limit are not reported, on either path
+            bdata = book.as_dict(app=current_app, list_limits={'tags': 10})
+            self.assertEqual(5, len(bdata.get('tags')))
+            self.assertTrue('_list_totals' not in bdata)
+            data = object_to_dict(Book.objects, app=current_app, list_limits={'tags': 10})
+            self.assertEqual(5, len(data[0].get('tags')))
+            self.assertTrue('_list_totals' not in data[0])
+
+            # list_totals=False is honoured whether capped in memory or in MongoDB
+            bdata = book.as_dict(app=current_app, list_limits={'tags': 2}, list_totals=False)
+            self.assertEqual(['a', 'b'], bdata.get('tags'))
+            self.assertTrue('_list_totals' not in bdata)
+            data = object_to_dict(Book.objects, app=current_app, list_limits={'tags': 2},
+                                  list_totals=False)
+            self.assertEqual(['a', 'b'], data[0].get('tags'))
+            self.assertTrue('_list_totals' not in data[0])
+
+    def test_explain_serialization(self):
+        from flask_mongoutils import explain_serialization, object_to_dict
+
+        def observed_derefs(obj, **options):
+            # The per-call statistics that MONGOUTILS_METRICS collects
+            stats = {}
+            object_to_dict(obj, app=current_app, _stats=stats, uri_fields=[], **options)
+            return stats.get('derefs', {})
+
+        with self.app.app_context():
+            options = dict(recursive=True, exclude_fields=['publisher'])
+
+            # A QuerySet takes a level of depth, so depth=2 only returns stubs
+            report = explain_serialization(Book.objects, depth=2, **options)
+            self.assertEqual(1, report.get('documents'))
+            self.assertEqual([], report.get('dereferences'))
+            self.assertEqual(1.0, report.get('queries'))
+            self.assertEqual({}, observed_derefs(Book.objects, depth=2, **options))
+
+            report = explain_serialization(Book.objects, depth=3, **options)
+            self.assertEqual(1, report.get('levels'))
+            self.assertEqual(['author'], [d['path'] for d in report.get('dereferences')])
+            self.assertEqual(observed_derefs(Book.objects, depth=3, **options).get('author'),
+                             report.get('collections').get('author').get('queries'))
+            # The root query plus one dereference
+            self.assertEqual(2.0, report.get('queries'))
+
+            book = Book.objects.first()
+            report = explain_serialization(book, depth=2, **options)
+            self.assertEqual(observed_derefs(book, depth=2, **options).get('author'),
+                             report.get('collections').get('author').get('queries'))
+
+            report = explain_serialization(book, recursive=True, depth=1)
+            self.assertEqual(0, report.get('queries'))
+            self.assertEqual({}, observed_derefs(book, recursive=True, depth=1))
+
+    def test_orphan_cache(self):
+        from flask_mongoutils import get_orphan_cache, orphan_report
+        with self.app.app_context():
+            book = Book.objects.first()
+            publisher_id = book.publisher.id
+            Publisher.drop_collection()
+
+            for _ in range(2):
+                bdata = Book.objects.first().as_dict(app=current_app, recursive=True, depth=2)
+                self.assertTrue(bdata.get('publisher') is None)
+
+            self.assertTrue(get_orphan_cache(current_app).is_orphan('publisher', publisher_id))
+            report = orphan_report(reset=True)
+            self.assertEqual(2, report.get('publisher').get('publisher').get('count'))
+            self.assertEqual({}, orphan_report())
+
+    def test_orphan_report_logged(self):
+        from flask_mongoutils import OrphanCache
+
+        class Logger(object):
+            def __init__(self):
+                self.messages = []
+            def error(self, message, *args, **kwargs):
+                self.messages.append(message)
+
+        logger = Logger()
+        orphans = OrphanCache(report_interval=0.1)
+        orphans.record('publisher', 'missing-id', 'publisher', logger)
+        # The timer resets _timer when it fires, so hold on to it
+        timer = orphans._timer
+        orphans.record('publisher', 'missing-id', 'publisher', logger)
+        # No further orphans: the summary is still logged once the interval is up
+        timer.join(5)
+
+        self.assertEqual(1, len(logger.messages))
+        self.assertTrue("'count': 2" in logger.messages[0])
+        self.assertEqual({}, orphans.report())
+
+    def test_query_options(self):
+        query_options = {'*': {'batch_size': 10},
+                         'author': {'read_preference': 'secondary_preferred',
+                                    'hint': [('_id', 1)]}}
+        with self.app.app_context():
+            book = Book.objects.first()
+            resp = book.as_dict(app=current_app, recursive=True, depth=4,
+                                query_options=query_options)
+            self.assertEqual('testauthor', resp.get('author').get('name'))
+
+    def test_fields_spec(self):
+        with self.app.app_context():
+            book = Book.objects.first()
+            for fields in ({'title': 1, 'author': {'name': 1}},
+                           ['title', 'author.name']):
+                resp = book.as_dict(app=current_app, fields=fields)
+                self.assertEqual('testbook', resp.get('title'))
+                self.assertTrue('publisher' not in resp)
+                self.assertTrue('tags' not in resp)
+                # Followed regardless of depth, and projected
+                self.assertEqual('testauthor', resp.get('author').get('name'))
+                self.assertTrue('uri' not in resp.get('author'))
+
+            # Only zeros: an exclusion, everything else is emitted
+            resp = book.as_dict(app=current_app, fields={'publisher': 0})
+            self.assertTrue('publisher' not in resp)
+            self.assertEqual('testbook', resp.get('title'))
+            # Not given a nested spec, so not followed
+            self.assertEqual('author', resp.get('author').get('collection'))
+
+            # Any non-zero value makes the level an inclusion
+            resp = book.as_dict(app=current_app, fields={'publisher': 0, 'author': 1})
+            self.assertEqual(set(['id', 'author']), set(resp.keys()))
+
+    def test_metrics(self):
+        from flask_mongoutils import metrics, metrics_blueprint
+        metrics.reset()
+        self.app.config['MONGOUTILS_METRICS'] = True
+        self.app.register_blueprint(metrics_blueprint())
+
+        @self.app.route('/book')
+        def book():
+            return str(Book.objects.first().as_dict(app=current_app, recursive=True, depth=2))
+
+        client = self.app.test_client()
+        client.get('/book')
+        text = client.get('/metrics').data.decode('utf-8')
+        self.assertTrue('mongoutils_serialization_seconds_count{endpoint="book"} 1' in text)
+        self.assertTrue('mongoutils_dereferences_total{endpoint="book",collection="author"} 1'
+                        in text)
+
+    def test_profile_sampling(self):
+        import os
+        import pstats
+        import shutil
+        import tempfile
+
+        tmpdir = tempfile.mkdtemp()
+        self.app.config['MONGOUTILS_PROFILE_SAMPLE_RATE'] = 1.0
+        self.app.config['MONGOUTILS_PROFILE_DIR'] = tmpdir
+        self.app.config['MONGOUTILS_PROFILE_KEEP'] = 1
+        try:
+            with self.app.app_context():
+                book = Book.objects.first()
+                for _ in range(2):
+                    book.as_dict(app=current_app, recursive=True, depth=2)
+
+            # Rotated down to the newest profile
+            files = sorted(os.listdir(tmpdir))
+            self.assertEqual(2, len(files))
+            prof = [f for f in files if f.endswith('.prof')][0]
+            pstats.Stats(os.path.join(tmpdir, prof))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_snapshots(self):
+        from flask_mongoutils import SnapshotStore
+        store = SnapshotStore(self.app, collection='test_snapshots')
+        store.register(Book, 'api', recursive=True, depth=2, uri_fields=[])
+        try:
+            with self.app.app_context():
+                self.assertEqual(1, store.rebuild())
+                book = Book.objects.first()
+                self.assertEqual('testauthor',
+                                 store.get(Book, book.pk, 'api').get('author').get('name'))
+
+                # Saving a referenced document refreshes the referencing snapshots
+                author = Author.objects.first()
+                author.name = 'renamed'
+                author.save()
+                self.assertEqual('renamed',
+                                 store.get(Book, book.pk, 'api').get('author').get('name'))
+
+                book.delete()
+                self.assertTrue(store.get(Book, book.pk, 'api') is None)
+        finally:
+            store.close()
+            Book._get_db().drop_collection('test_snapshots')
+
+    def test_tabular(self):
+        from flask_mongoutils import object_to_dict
+        with self.app.app_context():
+            book = Book.objects.first()
+            table = object_to_dict(Book.objects, app=current_app, tabular=True,
+                                   exclude_fields=['publisher'])
+            self.assertEqual(['id', 'title', 'author', 'tags'], table.get('columns'))
+            self.assertEqual([str(book.pk), 'testbook'], table.get('rows')[0][:2])
+
+            table = object_to_dict(Book.objects, app=current_app, tabular='columns',
+                                   recursive=True, depth=2, fields=['title', 'author.name'])
+            self.assertEqual(['id', 'title', 'author'], table.get('columns'))
+            self.assertEqual(['testbook'], table.get('data').get('title'))
+            self.assertEqual('testauthor', table.get('data').get('author')[0].get('name'))
+
+    def test_query_timeout_degrades_to_stub(self):
+        from mongoengine.queryset import QuerySet
+        from pymongo.errors import ExecutionTimeout
+
+        original = QuerySet.first
+        def first(queryset):
+            if queryset._document is Author:
+                raise ExecutionTimeout('operation exceeded time limit')
+            return original(queryset)
+
+        QuerySet.first = first
+        try:
+            with self.app.app_context():
+                book = Book.objects.first()
+                resp = book.as_dict(app=current_app, recursive=True, depth=4,
+                                    query_options={'author': {'max_time_ms': 1}})
+        finally:
+            QuerySet.first = original
+        self.assertEqual({'collection': 'author', 'id': str(book.author.pk)},
+                         resp.get('author'))
+        self.assertEqual('testpub', resp.get('publisher').get('name'))
+
+    def test_snapshot_on_save_matches_profile(self):
+        from flask_mongoutils import SnapshotStore
+        store = SnapshotStore(self.app, collection='test_snapshots')
+        store.register(Book, 'stubs', recursive=False)
+        try:
+            with self.app.app_context():
+                author = Author.objects.first()
+                # The saved instance holds the Author document, not a DBRef
+                book = Book(author=author, title='direct').save()
+                data = store.get(Book, book.pk, 'stubs')
+                self.assertEqual('direct', data.get('title'))
+                self.assertEqual({'collection': 'author', 'id': str(author.pk)},
+                                 data.get('author'))
+        finally:
+            store.close()
+            Book._get_db().drop_collection('test_snapshots')
+
+    def test_export_collection(self):
+        import json
+        import os
+        import shutil
+        import tempfile
+        from flask_mongoutils import export_collection
+
+        # Enough documents for several _id ranges
+        with self.app.app_context():
+            author = Author.objects.first()
+            for i in range(20):
+                Book(author=author, title='book %02d' % i).save()
+            ids = [str(book.pk) for book in Book.objects.order_by('id')]
+        self.assertEqual(21, len(ids))
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            output = os.path.join(tmpdir, 'books.ndjson')
+            paths, total = export_collection('test_mongoutils:create_app',
+                                             'myapp.book.models:Book', output,
+                                             processes=2, chunks=4, app_name='myapp',
+                                             depth=2, uri_fields=[])
+            self.assertEqual(21, total)
+            self.assertEqual([output], paths)
+            self.assertEqual(['books.ndjson'], os.listdir(tmpdir))
+            with open(output) as fh:
+                rows = [json.loads(line) for line in fh]
+            # Part files are merged in _id order
+            self.assertEqual(ids, [row.get('id') for row in rows])
+            self.assertEqual('testbook', rows[0].get('title'))
+            self.assertEqual('testauthor', rows[0].get('author').get('name'))
+
+            sharded = os.path.join(tmpdir, 'shard')
+            paths, total = export_collection('test_mongoutils:create_app',
+                                             'myapp.book.models:Book', sharded,
+                                             processes=2, chunks=4, app_name='myapp',
+                                             sharded=True, uri_fields=[])
+            self.assertEqual(21, total)
+            self.assertEqual(4, len(paths))
+            self.assertEqual(sorted(paths), paths)
+            rows = []
+            for path in paths:
+                with open(path) as fh:
+                    rows.extend(json.loads(line) for line in fh)
+            self.assertEqual(ids, [row.get('id') for row in rows])
+        finally:
+            shutil.rmtree(tmpdir)
+
 
 def suite():
     suite = unittest.TestSuite()